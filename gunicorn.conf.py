@@ -0,0 +1,9 @@
+bind = "0.0.0.0:10000"
+workers = 4
+worker_class = "gthread"
+# Requests are ~99% network I/O wait, so threads are cheap; size the pool
+# for many concurrent cold misses rather than for CPU
+threads = 32
+timeout = 120
+# Build the YTMusic/youtube clients once in the master before forking
+preload_app = True
@@ -1,289 +1,902 @@
-from flask import Flask, request, jsonify, Response, stream_with_context
-from youtube_transcript_api import YouTubeTranscriptApi
-from youtube_transcript_api.formatters import TextFormatter
-from googleapiclient.discovery import build
-from ytmusicapi import YTMusic
-import yt_dlp
-import hashlib
-import os
-import json
-import shutil
-# ---------- CONFIG ----------
-YOUTUBE_API_KEY = os.getenv("YOUTUBE_API_KEY", "test_key")
-CACHE_DIR = "music_cache"
-os.makedirs(CACHE_DIR, exist_ok=True)
-
-app = Flask(__name__)
-youtube = build("youtube", "v3", developerKey=YOUTUBE_API_KEY)
-ytm = YTMusic()
-
-
-# ---------- HELPERS ----------
-def get_cache_id(query: str):
-    return hashlib.md5(query.encode("utf-8")).hexdigest()
-
-def make_meta_json(cache_id, artist, title, duration, thumbnail):
-    """Build the JSON response"""
-    return {
-        "artist": artist,
-        "audio_url": f"/{CACHE_DIR}/{cache_id}.mp3",
-        "cover_url": thumbnail,
-        "duration": duration,
-        "from_cache": True,
-        "lyric_url": f"/{CACHE_DIR}/{cache_id}.lrc",
-        "title": title
-    }
-
-
-# ---------- STREAM PCM ----------
-@app.route("/stream_pcm")
-def stream_pcm():
-    song = request.args.get("song")
-    artist = request.args.get("artist", "")
-    if not song:
-        return jsonify({"error": "Missing song"}), 400
-
-    query = f"{song} {artist}".strip()
-    cache_id = get_cache_id(query)
-    mp3_path = f"{CACHE_DIR}/{cache_id}.mp3"
-    lrc_path = f"{CACHE_DIR}/{cache_id}.lrc"
-    meta_path = f"{CACHE_DIR}/{cache_id}.json"
-
-    # 1️⃣ If cached → return cached JSON immediately
-    if os.path.exists(meta_path):
-        with open(meta_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            data["from_cache"] = True
-            return jsonify(data)
-
-    # 2️⃣ Search YouTube
-    search = youtube.search().list(
-        q=query,
-        part="id,snippet",
-        maxResults=1,
-        type="video"
-    ).execute()
-
-    if not search["items"]:
-        return jsonify({"error": "No video found"}), 404
-
-    video = search["items"][0]
-    video_id = video["id"]["videoId"]
-    title = video["snippet"]["title"]
-    artist_name = video["snippet"]["channelTitle"]
-    thumbnail = video["snippet"]["thumbnails"]["high"]["url"]
-
-    # 3️⃣ Download audio
-    ydl_opts = {
-        "format": "bestaudio/best",
-        "outtmpl": f"{CACHE_DIR}/{cache_id}.%(ext)s",
-        "quiet": True,
-        "noplaylist": True,
-        "postprocessors": [{
-            "key": "FFmpegExtractAudio",
-            "preferredcodec": "mp3",
-            "preferredquality": "128",
-        }],
-         "cookiefile": "/etc/secrets/cookiesyt.txt",  # Use cookies for authentication
-    }
-    cookie_file = "/etc/secrets/cookiesyt.txt"
-    try:
-        with open(cookie_file, "a") as f:
-            pass  # Test if the file is writable
-    except IOError:
-        writable_cookie_file = "cookiesyt_writable.txt"
-        shutil.copy(cookie_file, writable_cookie_file)
-        cookie_file = writable_cookie_file
-
-    # Update ydl_opts to use the writable cookie file
-    ydl_opts["cookiefile"] = cookie_file
-
-    try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(f"https://www.youtube.com/watch?v={video_id}", download=True)
-            duration = info.get("duration", 0)
-    except Exception as e:
-        return jsonify({"error": f"Download failed: {e}"}), 500
-
-    # 4️⃣ Get lyrics (YouTube Music → fallback transcript)
-    lyrics_text = ""
-    try:
-        search_ytm = ytm.search(query, filter="songs")
-        if search_ytm:
-            song_info = ytm.get_song(search_ytm[0]["videoId"])
-            if "lyrics" in song_info and "browseId" in song_info["lyrics"]:
-                lyrics_data = ytm.get_lyrics(song_info["lyrics"]["browseId"])
-                if lyrics_data and lyrics_data.get("lyrics"):
-                    lyrics_text = lyrics_data["lyrics"]
-    except Exception:
-        pass
-
-    if not lyrics_text:
-        try:
-            transcript = YouTubeTranscriptApi().fetch(video_id, languages=["vi", "en"])
-            formatter = TextFormatter()
-            lyrics_text = formatter.format_transcript(transcript)
-        except Exception:
-            lyrics_text = ""
-
-    # Save lyrics
-    with open(lrc_path, "w", encoding="utf-8") as f:
-        f.write(lyrics_text)
-
-    # 5️⃣ Save metadata
-    data = make_meta_json(cache_id, artist_name, title, duration, thumbnail)
-    with open(meta_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
-    return jsonify(data)
-
-
-# ---------- STATIC FILE SERVE ----------
-@app.route(f"/{CACHE_DIR}/<path:filename>")
-def serve_cache(filename):
-    full_path = os.path.join(CACHE_DIR, filename)
-    if not os.path.exists(full_path):
-        return jsonify({"error": "file not found"}), 404
-
-    # Detect MIME
-    if filename.endswith(".mp3"):
-        mimetype = "audio/mpeg"
-    elif filename.endswith(".lrc") or filename.endswith(".txt"):
-        mimetype = "text/plain; charset=utf-8"
-    elif filename.endswith(".json"):
-        mimetype = "application/json"
-    else:
-        mimetype = "application/octet-stream"
-
-    def generate():
-        with open(full_path, "rb") as f:
-            while chunk := f.read(4096):
-                yield chunk
-    return Response(stream_with_context(generate()), mimetype=mimetype)
-
-
-# ---------- WEB UI ----------
-@app.route("/")
-def web_ui():
-    return """
-<!DOCTYPE html>
-<html lang="en">
-<head>
-<meta charset="UTF-8" />
-<meta name="viewport" content="width=device-width, initial-scale=1.0">
-<title>🎵 ESP32 Music Server</title>
-<style>
-body {
-  font-family: Arial, sans-serif;
-  background: #101010;
-  color: #eee;
-  display: flex;
-  flex-direction: column;
-  align-items: center;
-  justify-content: flex-start;
-  min-height: 100vh;
-  margin: 0;
-  padding: 2rem;
-}
-h2 {
-  margin-bottom: 1rem;
-  color: #00ff88;
-}
-input, button {
-  font-size: 1rem;
-  padding: 0.5rem;
-  border-radius: 0.5rem;
-  border: none;
-  margin: 0.25rem;
-}
-input {
-  width: 300px;
-}
-button {
-  background: #00ff88;
-  color: black;
-  cursor: pointer;
-}
-button:hover {
-  background: #00cc66;
-}
-img {
-  border-radius: 0.75rem;
-  margin: 1rem 0;
-  box-shadow: 0 0 20px rgba(0,255,136,0.3);
-}
-#lyrics {
-  white-space: pre-wrap;
-  max-width: 600px;
-  text-align: left;
-  background: #181818;
-  padding: 1rem;
-  border-radius: 1rem;
-  box-shadow: 0 0 10px rgba(255,255,255,0.1);
-}
-audio {
-  margin-top: 1rem;
-  width: 90%;
-  max-width: 600px;
-}
-</style>
-</head>
-<body>
-  <h2>🎶 ESP32 YouTube Music Server</h2>
-  <div>
-    <input id="song" type="text" placeholder="Enter song title..." />
-    <input id="artist" type="text" placeholder="Artist (optional)" />
-    <button onclick="searchMusic()">Search</button>
-  </div>
-
-  <div id="result" style="display:none;">
-    <h3 id="title"></h3>
-    <p id="artist_name"></p>
-    <img id="cover" src="" width="200" />
-    <audio id="player" controls></audio>
-    <h4>Lyrics</h4>
-    <div id="lyrics">Loading...</div>
-  </div>
-
-<script>
-async function searchMusic() {
-  const song = document.getElementById('song').value.trim();
-  const artist = document.getElementById('artist').value.trim();
-  if (!song) return alert("Please enter a song name!");
-  const query = encodeURIComponent(song + " " + artist);
-  document.getElementById('result').style.display = 'none';
-  document.getElementById('lyrics').innerText = '';
-
-  try {
-    const res = await fetch(`/stream_pcm?song=${query}`);
-    const data = await res.json();
-    if (data.error) throw new Error(data.error);
-
-    document.getElementById('result').style.display = 'block';
-    document.getElementById('title').innerText = data.title;
-    document.getElementById('artist_name').innerText = data.artist;
-    document.getElementById('cover').src = data.cover_url;
-    document.getElementById('player').src = data.audio_url;
-
-    const lrcRes = await fetch(data.lyric_url);
-    const lrcText = await lrcRes.text();
-    document.getElementById('lyrics').innerText = lrcText || 'No lyrics available.';
-  } catch (err) {
-    alert("Error: " + err.message);
-  }
-}
-</script>
-</body>
-</html>
-"""
-
-
-
-
-# ---------- MAIN ----------
-if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=10000, threaded=True, debug=True)
-
-
-
-
+from flask import Flask, request, send_from_directory, Response
+from youtube_transcript_api import YouTubeTranscriptApi
+from youtube_transcript_api.formatters import TextFormatter
+from ytmusicapi import YTMusic
+import yt_dlp
+import cachetools
+import redis
+import requests
+import concurrent.futures
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import hashlib
+import orjson
+import os
+import math
+import mimetypes
+import queue
+import sqlite3
+from collections import Counter
+import shutil
+import threading
+import time
+# ---------- CONFIG ----------
+CACHE_DIR = "music_cache"
+os.makedirs(CACHE_DIR, exist_ok=True)
+
+def _resolve_cookie_file(path):
+    """yt-dlp needs a writable cookie jar; /etc/secrets is read-only on
+    Render, so copy the cookies next to the app once if necessary."""
+    if os.access(path, os.W_OK):
+        return path
+    writable = "cookiesyt_writable.txt"
+    try:
+        shutil.copy(path, writable)
+    except OSError:
+        return path
+    return writable
+
+COOKIE_FILE = _resolve_cookie_file("/etc/secrets/cookiesyt.txt")
+
+# Teach the stdlib about the cache file types so send_from_directory can
+# resolve MIME types without a manual dispatch table
+mimetypes.add_type("audio/mpeg", ".mp3")
+mimetypes.add_type("audio/ogg", ".opus")
+mimetypes.add_type("text/plain", ".lrc")
+
+# Opus at 96 kbps matches 128 kbps MP3 in perceived quality at fewer bytes
+# over the wire and a cheaper ffmpeg encode. Entries downloaded as .mp3
+# before the switch keep serving — their meta.json records the old URL.
+AUDIO_EXT = "opus"
+AUDIO_QUALITY = "96"
+
+app = Flask(__name__)
+
+# Build the YTMusic client once at import with a keep-alive connection pool
+# so warm workers reuse TLS sessions instead of paying a handshake per call
+# (gunicorn's preload_app additionally builds this once pre-fork)
+_ytm_session = requests.Session()
+_ytm_session.mount("https://", HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=100,
+    max_retries=Retry(total=3, backoff_factor=0.2),
+))
+ytm = YTMusic(requests_session=_ytm_session)
+
+
+# In-memory metadata cache + in-flight download registry. The LRU avoids
+# hitting the disk for hot queries; the Event registry coalesces concurrent
+# misses for the same cache_id into a single download ("single-flight").
+# LRUCache is not thread-safe and is touched from request threads, the
+# writer pool, and the evictor, so every access goes through its lock.
+_META_CACHE = cachetools.LRUCache(maxsize=2048)
+_META_CACHE_LOCK = threading.Lock()
+_INFLIGHT = {}
+_INFLIGHT_LOCK = threading.Lock()
+
+# All on-disk paths for one cache entry, built in one place
+CacheEntry = namedtuple("CacheEntry", ["audio", "lrc", "meta"])
+
+def _paths_for(cache_id):
+    return CacheEntry(
+        os.path.join(CACHE_DIR, f"{cache_id}.{AUDIO_EXT}"),
+        os.path.join(CACHE_DIR, f"{cache_id}.lrc"),
+        os.path.join(CACHE_DIR, f"{cache_id}.json"),
+    )
+
+# Known cache ids, hydrated with one directory scan at startup — replaces a
+# stat syscall per request on the warm path
+CACHED_IDS = {name[:-5] for name in os.listdir(CACHE_DIR) if name.endswith(".json")}
+
+# Failed searches are cached too, so repeated typos don't re-burn Data API
+# quota; the TTL keeps them from sticking around forever. Missing lyrics
+# need no TTL — the empty .lrc marker written on the miss path already
+# counts as a hit.
+NO_VIDEO_TTL = 3600
+
+# Hard caps on how long a single request may pin a worker thread — slow
+# downloads fail fast instead of holding a gthread for minutes, and lyrics
+# are best-effort
+DOWNLOAD_TIMEOUT = 120
+LYRICS_TIMEOUT = 30
+
+# Cross-worker coordination: the LRU and in-flight registry above are
+# per-process, so under multi-worker gunicorn two workers can race the same
+# download. When REDIS_URL is set, Redis acts as a shared metadata tier and
+# a SET NX download lock; without it the per-process behaviour is unchanged.
+REDIS_URL = os.getenv("REDIS_URL", "")
+REDIS_META_TTL = 86400
+REDIS_LOCK_TTL = 300
+
+_REDIS = None
+if REDIS_URL:
+    _REDIS = redis.Redis(
+        connection_pool=redis.BlockingConnectionPool.from_url(REDIS_URL, max_connections=32)
+    )
+
+# Background prefetch: misses are queued so popular tracks whose foreground
+# download failed (or that were evicted) get re-fetched during idle time,
+# turning the next request into a hit. The worker is rate-limited so
+# prefetching never competes with foreground traffic for long.
+PREFETCH_QUEUE_SIZE = 256
+PREFETCH_PER_HOUR = 30
+PREFETCH_MIN_HITS = 2  # only re-fetch queries that were asked for twice
+
+_PREFETCH_QUEUE = queue.Queue(maxsize=PREFETCH_QUEUE_SIZE)
+_POPULARITY = Counter()
+_PREFETCH_STARTED = False
+_PREFETCH_START_LOCK = threading.Lock()
+
+# Cache eviction: the directory used to grow until the disk filled and
+# downloads died with ENOSPC. Entries are indexed in SQLite and a
+# background thread removes the coldest ones — access frequency decayed by
+# recency, TinyLFU-style — whenever the directory exceeds its byte budget.
+MAX_CACHE_BYTES = int(os.getenv("MAX_CACHE_BYTES", 10 * 2**30))
+EVICTION_INTERVAL = 300
+EVICTION_BATCH = 50
+
+# Kept outside CACHE_DIR — everything in there is served publicly
+CACHE_DB_PATH = "cache.db"
+
+_CACHE_DB = None
+_CACHE_DB_LOCK = threading.Lock()
+
+def _open_cache_db():
+    db = sqlite3.connect(CACHE_DB_PATH, check_same_thread=False)
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS cache ("
+        " cache_id TEXT PRIMARY KEY,"
+        " size INTEGER NOT NULL DEFAULT 0,"
+        " last_access REAL NOT NULL,"
+        " access_count INTEGER NOT NULL DEFAULT 0)"
+    )
+    db.commit()
+    # python:3.9-slim ships SQLite without the math functions
+    db.create_function("exp", 1, math.exp)
+    return db
+
+def _get_cache_db():
+    """Per-process connection, opened lazily. An import-time connection
+    would be created in the preloaded gunicorn master and carried across
+    fork(), which SQLite connections must never be — the same reason the
+    background threads start lazily. Callers must hold _CACHE_DB_LOCK.
+    """
+    global _CACHE_DB
+    if _CACHE_DB is None:
+        _CACHE_DB = _open_cache_db()
+    return _CACHE_DB
+
+_EVICTOR_STARTED = False
+_EVICTOR_START_LOCK = threading.Lock()
+
+# Shared pool so the audio download and the lyrics lookup can overlap
+_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="stream-pcm")
+
+# Cache files are persisted off the request thread — the client only needs
+# the JSON body, not the fsync
+_WRITER = ThreadPoolExecutor(max_workers=4, thread_name_prefix="cache-writer")
+
+
+# ---------- HELPERS ----------
+def get_cache_id(query: str):
+    # BLAKE2b-128 is ~3× faster than MD5 on short strings; cache_id only
+    # names files on disk, so no cryptographic strength is required.
+    return hashlib.blake2b(query.encode("utf-8"), digest_size=16).hexdigest()
+
+def get_legacy_cache_id(query: str):
+    """Cache key used before the MD5 → BLAKE2b migration."""
+    return hashlib.md5(query.encode("utf-8")).hexdigest()
+
+def get_cached_meta(cache_id, meta_path):
+    """Return cached metadata from the LRU, lazily warming it from disk.
+
+    May return a negative entry ({"error": ..., "expires": ...}) while its
+    TTL has not elapsed.
+    """
+    with _META_CACHE_LOCK:
+        entry = _META_CACHE.get(cache_id)
+        if entry is not None and "error" in entry:
+            if entry["expires"] > time.time():
+                return entry
+            del _META_CACHE[cache_id]
+            entry = None
+    if entry is not None:
+        if not _audio_missing(entry):
+            return entry
+        # the audio file was evicted (possibly by another worker) after
+        # this entry was cached — drop it and fall through to a miss
+        CACHED_IDS.discard(cache_id)
+        with _META_CACHE_LOCK:
+            _META_CACHE.pop(cache_id, None)
+    # CACHED_IDS is per-process, so without Redis a track downloaded by
+    # another gunicorn worker is invisible to it; spend one stat on a set
+    # miss before concluding the entry doesn't exist. The warm path (LRU or
+    # CACHED_IDS hit) still avoids the syscall.
+    if cache_id in CACHED_IDS or os.path.exists(meta_path):
+        try:
+            with open(meta_path, "rb") as f:
+                data = orjson.loads(f.read())
+        except FileNotFoundError:
+            # lost a race with the evictor — treat it as a plain miss
+            CACHED_IDS.discard(cache_id)
+        else:
+            data["from_cache"] = True
+            CACHED_IDS.add(cache_id)
+            with _META_CACHE_LOCK:
+                _META_CACHE[cache_id] = data
+            return data
+    data = _redis_get_meta(cache_id)
+    if data is not None and not _audio_missing(data):
+        data["from_cache"] = True
+        with _META_CACHE_LOCK:
+            _META_CACHE[cache_id] = data
+        return data
+    return None
+
+def _audio_missing(data):
+    """True when a cached entry's audio file no longer exists on disk.
+
+    audio_url is "/{CACHE_DIR}/...", so stripping the leading slash yields
+    the local path; this also covers pre-Opus .mp3 entries.
+    """
+    return not os.path.exists(data["audio_url"].lstrip("/"))
+
+def _redis_get_meta(cache_id):
+    """Look up metadata another worker published to the shared Redis tier."""
+    if _REDIS is None:
+        return None
+    try:
+        raw = _REDIS.get(f"meta:{cache_id}")
+    except redis.RedisError:
+        return None
+    return orjson.loads(raw) if raw else None
+
+def _acquire_dl_lock(cache_id):
+    """Try to take the cross-worker download lock.
+
+    Returns (got_lock, denied): denied means another worker holds it. A
+    Redis outage counts as neither — the caller degrades to per-process
+    single-flight.
+    """
+    if _REDIS is None:
+        return False, False
+    try:
+        got = bool(_REDIS.set(f"dl:{cache_id}", "1", nx=True, ex=REDIS_LOCK_TTL))
+        return got, not got
+    except redis.RedisError:
+        return False, False
+
+def _release_dl_lock(cache_id):
+    try:
+        _REDIS.delete(f"dl:{cache_id}")
+    except redis.RedisError:
+        pass
+
+def _wait_for_file(path, timeout):
+    """Poll until another worker's download lands on disk."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if os.path.exists(path):
+            return True
+        time.sleep(0.5)
+    return False
+
+def _sync_cache_db():
+    """Index cache files that predate the SQLite bookkeeping (one scan).
+
+    Runs at import — in the preloaded gunicorn master — so it uses its own
+    short-lived connection; no handle survives into the forked workers.
+    """
+    sizes = Counter()
+    with os.scandir(CACHE_DIR) as entries:
+        for dirent in entries:
+            stem, ext = os.path.splitext(dirent.name)
+            if stem in CACHED_IDS and ext in (".mp3", f".{AUDIO_EXT}", ".lrc", ".json"):
+                sizes[stem] += dirent.stat().st_size
+    now = time.time()
+    db = _open_cache_db()
+    try:
+        db.executemany(
+            "INSERT OR IGNORE INTO cache (cache_id, size, last_access) VALUES (?, ?, ?)",
+            [(cid, size, now) for cid, size in sizes.items()],
+        )
+        db.commit()
+    finally:
+        db.close()
+
+_sync_cache_db()
+
+def _ensure_evictor():
+    """Start the eviction thread lazily so it lives in each forked worker."""
+    global _EVICTOR_STARTED
+    if not _EVICTOR_STARTED:
+        with _EVICTOR_START_LOCK:
+            if not _EVICTOR_STARTED:
+                threading.Thread(
+                    target=_eviction_worker, daemon=True, name="cache-evictor"
+                ).start()
+                _EVICTOR_STARTED = True
+
+def _touch_cache_entry(cache_id):
+    """Bump recency/frequency for a hit; runs on the writer pool."""
+    _ensure_evictor()
+    with _CACHE_DB_LOCK:
+        db = _get_cache_db()
+        db.execute(
+            "UPDATE cache SET last_access = ?, access_count = access_count + 1"
+            " WHERE cache_id = ?",
+            (time.time(), cache_id),
+        )
+        db.commit()
+
+def _record_cache_entry(cache_id, paths):
+    """Index a freshly downloaded entry; runs on the writer pool."""
+    _ensure_evictor()
+    size = 0
+    for path in paths:
+        try:
+            size += os.path.getsize(path)
+        except OSError:
+            pass
+    with _CACHE_DB_LOCK:
+        db = _get_cache_db()
+        db.execute(
+            "INSERT OR REPLACE INTO cache (cache_id, size, last_access, access_count)"
+            " VALUES (?, ?, ?, 1)",
+            (cache_id, size, time.time()),
+        )
+        db.commit()
+
+def _evict_entry(cache_id):
+    # Drop the id from the lookup structures before unlinking so a
+    # concurrent get_cached_meta can't pass the membership check and then
+    # try to open a just-deleted meta.json
+    CACHED_IDS.discard(cache_id)
+    with _META_CACHE_LOCK:
+        _META_CACHE.pop(cache_id, None)
+    for path in _paths_for(cache_id):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    # entries downloaded before the Opus switch still hold an .mp3
+    try:
+        os.remove(os.path.join(CACHE_DIR, f"{cache_id}.mp3"))
+    except OSError:
+        pass
+    # also drop the copy published to the shared tier, or other workers
+    # would keep serving metadata for the deleted files until the TTL
+    if _REDIS is not None:
+        try:
+            _REDIS.delete(f"meta:{cache_id}")
+        except redis.RedisError:
+            pass
+    with _CACHE_DB_LOCK:
+        db = _get_cache_db()
+        db.execute("DELETE FROM cache WHERE cache_id = ?", (cache_id,))
+        db.commit()
+
+def _eviction_worker():
+    while True:
+        time.sleep(EVICTION_INTERVAL)
+        try:
+            with _CACHE_DB_LOCK:
+                total = _get_cache_db().execute(
+                    "SELECT COALESCE(SUM(size), 0) FROM cache"
+                ).fetchone()[0]
+            if total <= MAX_CACHE_BYTES:
+                continue
+            with _CACHE_DB_LOCK:
+                victims = _get_cache_db().execute(
+                    "SELECT cache_id FROM cache"
+                    " ORDER BY access_count * exp(-((? - last_access) / 86400.0)) ASC"
+                    " LIMIT ?",
+                    (time.time(), EVICTION_BATCH),
+                ).fetchall()
+            for (cache_id,) in victims:
+                if cache_id in _INFLIGHT:
+                    continue
+                _evict_entry(cache_id)
+        except Exception:
+            pass
+
+def _note_popularity(cache_id):
+    """Count a request for this cache_id (shared via Redis when available)."""
+    if _REDIS is not None:
+        try:
+            _REDIS.incr(f"pop:{cache_id}")
+            return
+        except redis.RedisError:
+            pass
+    _POPULARITY[cache_id] += 1
+
+def _popularity(cache_id):
+    if _REDIS is not None:
+        try:
+            return int(_REDIS.get(f"pop:{cache_id}") or 0)
+        except redis.RedisError:
+            pass
+    return _POPULARITY[cache_id]
+
+def _request_prefetch(cache_id, query):
+    """Queue a query for background download; drops silently when full.
+
+    The worker thread is started lazily so it exists in every gunicorn
+    worker — a thread started at import would stay behind in the preloaded
+    master and never survive the fork.
+    """
+    global _PREFETCH_STARTED
+    if not _PREFETCH_STARTED:
+        with _PREFETCH_START_LOCK:
+            if not _PREFETCH_STARTED:
+                threading.Thread(
+                    target=_prefetch_worker, daemon=True, name="prefetch"
+                ).start()
+                _PREFETCH_STARTED = True
+    try:
+        _PREFETCH_QUEUE.put_nowait((cache_id, query))
+    except queue.Full:
+        pass
+
+def _prefetch_worker():
+    min_interval = 3600.0 / PREFETCH_PER_HOUR
+    while True:
+        cache_id, query = _PREFETCH_QUEUE.get()
+        # Entries are queued while the foreground request is still
+        # downloading them, so wait for that attempt to settle before
+        # judging the outcome — checking _INFLIGHT immediately would always
+        # be true and silently drop every retry candidate
+        with _INFLIGHT_LOCK:
+            inflight = _INFLIGHT.get(cache_id)
+        if inflight is not None:
+            inflight.wait(timeout=DOWNLOAD_TIMEOUT)
+        # Only repeat queries whose cache files still don't exist are retried
+        if cache_id in CACHED_IDS:
+            continue
+        if _popularity(cache_id) < PREFETCH_MIN_HITS:
+            continue
+        # The retry goes through the same single-flight machinery as
+        # stream_pcm — register the in-flight Event and take the
+        # cross-worker lock so a foreground request arriving mid-prefetch
+        # coalesces instead of racing a second download
+        with _INFLIGHT_LOCK:
+            if cache_id in _INFLIGHT:
+                continue
+            inflight = threading.Event()
+            _INFLIGHT[cache_id] = inflight
+        got_lock = False
+        try:
+            got_lock, lock_denied = _acquire_dl_lock(cache_id)
+            if lock_denied:
+                continue
+            try:
+                _stream_pcm_miss(query, cache_id, _paths_for(cache_id))
+            except Exception:
+                pass
+        finally:
+            if got_lock:
+                _release_dl_lock(cache_id)
+            with _INFLIGHT_LOCK:
+                _INFLIGHT.pop(cache_id, None)
+            inflight.set()
+        time.sleep(min_interval)
+
+
+def _json_response(data, status=200):
+    """jsonify equivalent on orjson — ~5-10× faster on non-ASCII payloads."""
+    return Response(orjson.dumps(data), status=status, mimetype="application/json")
+
+def _meta_response(data):
+    """Turn a cache entry into a response, mapping negative entries to 404."""
+    if "error" in data:
+        return _json_response({"error": data["error"]}, 404)
+    return _json_response(data)
+
+def _atomic_write_text(path, text):
+    """Write via a temp file + os.replace so readers never see partial data."""
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+def _atomic_write_json(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    os.replace(tmp, path)
+
+def _download_audio(video_id, ydl_opts):
+    """Download the audio for a video and return its duration in seconds."""
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(f"https://www.youtube.com/watch?v={video_id}", download=True)
+        return info.get("duration", 0)
+
+def _search_and_download(query, ydl_opts):
+    """Resolve a free-text query and download its audio in one yt-dlp pass.
+
+    ytsearch scrapes youtube.com/results, so this costs no Data API quota.
+    Returns the result entry (id/title/uploader/thumbnail/duration) or None.
+    """
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(f"ytsearch1:{query}", download=True)
+    entries = info.get("entries") or []
+    return entries[0] if entries else None
+
+def _fetch_lyrics(query, video_id, ytm_video_id=None):
+    """Get lyrics (YouTube Music → fallback transcript).
+
+    ytm_video_id lets callers that already resolved the song via
+    ytm.search skip a duplicate search here.
+    """
+    lyrics_text = ""
+    try:
+        if ytm_video_id is None:
+            search_ytm = ytm.search(query, filter="songs")
+            if search_ytm:
+                ytm_video_id = search_ytm[0]["videoId"]
+        if ytm_video_id:
+            song_info = ytm.get_song(ytm_video_id)
+            if "lyrics" in song_info and "browseId" in song_info["lyrics"]:
+                lyrics_data = ytm.get_lyrics(song_info["lyrics"]["browseId"])
+                if lyrics_data and lyrics_data.get("lyrics"):
+                    lyrics_text = lyrics_data["lyrics"]
+    except Exception:
+        pass
+
+    if not lyrics_text:
+        try:
+            transcript = YouTubeTranscriptApi().fetch(video_id, languages=["vi", "en"])
+            formatter = TextFormatter()
+            lyrics_text = formatter.format_transcript(transcript)
+        except Exception:
+            lyrics_text = ""
+    return lyrics_text
+
+def make_meta_json(cache_id, artist, title, duration, thumbnail):
+    """Build the JSON response"""
+    return {
+        "artist": artist,
+        "audio_url": f"/{CACHE_DIR}/{cache_id}.{AUDIO_EXT}",
+        "cover_url": thumbnail,
+        "duration": duration,
+        "from_cache": True,
+        "lyric_url": f"/{CACHE_DIR}/{cache_id}.lrc",
+        "title": title
+    }
+
+
+# ---------- STREAM PCM ----------
+@app.route("/stream_pcm")
+def stream_pcm():
+    song = request.args.get("song")
+    artist = request.args.get("artist", "")
+    if not song:
+        return _json_response({"error": "Missing song"}, 400)
+
+    query = f"{song} {artist}".strip()
+    cache_id = get_cache_id(query)
+    paths = _paths_for(cache_id)
+    _note_popularity(cache_id)
+
+    # 1️⃣ If cached → return cached JSON immediately
+    hit_id = cache_id
+    data = get_cached_meta(cache_id, paths.meta)
+    if data is None:
+        # Entries downloaded before the MD5 → BLAKE2b migration still live
+        # under their old key; keep serving them instead of re-downloading.
+        legacy_id = get_legacy_cache_id(query)
+        data = get_cached_meta(legacy_id, _paths_for(legacy_id).meta)
+        hit_id = legacy_id
+    if data is not None:
+        if "error" not in data:
+            _WRITER.submit(_touch_cache_entry, hit_id)
+        return _meta_response(data)
+
+    # Single-flight: only the first request for an uncached cache_id runs the
+    # download pipeline; concurrent duplicates wait and re-read the cache.
+    with _INFLIGHT_LOCK:
+        inflight = _INFLIGHT.get(cache_id)
+        if inflight is None:
+            inflight = threading.Event()
+            _INFLIGHT[cache_id] = inflight
+            is_owner = True
+        else:
+            is_owner = False
+
+    if not is_owner:
+        inflight.wait(timeout=300)
+        data = get_cached_meta(cache_id, paths.meta)
+        if data is not None:
+            return _meta_response(data)
+        return _json_response({"error": "Download failed"}, 500)
+
+    got_lock = False
+    try:
+        # Cross-worker single-flight: if another gunicorn worker holds the
+        # download lock, wait for its files instead of racing a second ffmpeg
+        if _REDIS is not None:
+            got_lock, lock_denied = _acquire_dl_lock(cache_id)
+            if lock_denied:
+                if _wait_for_file(paths.meta, DOWNLOAD_TIMEOUT):
+                    data = get_cached_meta(cache_id, paths.meta)
+                    if data is not None:
+                        return _meta_response(data)
+                return _json_response({"error": "Download failed"}, 500)
+        # Remember the miss so the prefetch worker can retry it later if
+        # this attempt fails
+        _request_prefetch(cache_id, query)
+        return _stream_pcm_miss(query, cache_id, paths)
+    finally:
+        # Always release the cross-worker lock — leaving it behind on an
+        # error return would make every worker poll disk for the full TTL
+        if got_lock:
+            _release_dl_lock(cache_id)
+        with _INFLIGHT_LOCK:
+            _INFLIGHT.pop(cache_id, None)
+        inflight.set()
+
+
+def _stream_pcm_miss(query, cache_id, paths):
+    """Run the full search + download + lyrics pipeline for a cache miss."""
+    ydl_opts = {
+        "format": "bestaudio/best",
+        "outtmpl": f"{CACHE_DIR}/{cache_id}.%(ext)s",
+        "quiet": True,
+        "noplaylist": True,
+        # HLS/DASH audio is delivered in fragments; fetching them in
+        # parallel multiplies download throughput on cold misses
+        "concurrent_fragment_downloads": 8,
+        "retries": 3,
+        "fragment_retries": 5,
+        "http_chunk_size": 10_485_760,
+        "postprocessors": [{
+            "key": "FFmpegExtractAudio",
+            "preferredcodec": AUDIO_EXT,
+            "preferredquality": AUDIO_QUALITY,
+        }],
+         "cookiefile": COOKIE_FILE,  # Use cookies for authentication
+    }
+    if shutil.which("aria2c"):
+        ydl_opts["external_downloader"] = {"m3u8": "aria2c", "dash": "aria2c"}
+        ydl_opts["external_downloader_args"] = {"aria2c": ["-x", "8", "-s", "8", "-k", "1M"]}
+
+    # 2️⃣ Resolve the video — YTMusic first, falling back to yt-dlp's
+    # ytsearch (an HTML results-page scrape); neither costs Data API quota
+    try:
+        hits = ytm.search(query, filter="songs", limit=1)
+    except Exception:
+        hits = []
+
+    if hits:
+        hit = hits[0]
+        video_id = hit["videoId"]
+        title = hit["title"]
+        artist_name = hit["artists"][0]["name"] if hit.get("artists") else ""
+        thumbnail = hit["thumbnails"][-1]["url"]
+
+        # 3️⃣ + 4️⃣ Download audio and fetch lyrics in parallel — the lyrics
+        # lookup only needs query/video_id, so it can overlap the download
+        fut_audio = _POOL.submit(_download_audio, video_id, ydl_opts)
+        fut_lyrics = _POOL.submit(_fetch_lyrics, query, video_id, video_id)
+
+        try:
+            duration = fut_audio.result(timeout=DOWNLOAD_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            return _json_response({"error": "Download timed out"}, 504)
+        except Exception as e:
+            return _json_response({"error": f"Download failed: {e}"}, 500)
+    else:
+        # 3️⃣ yt-dlp already runs on the miss path, so fold search and
+        # download into one pass
+        try:
+            entry = _search_and_download(query, ydl_opts)
+        except Exception as e:
+            return _json_response({"error": f"Download failed: {e}"}, 500)
+
+        if entry is None:
+            with _META_CACHE_LOCK:
+                _META_CACHE[cache_id] = {
+                    "error": "No video found",
+                    "expires": time.time() + NO_VIDEO_TTL,
+                }
+            return _json_response({"error": "No video found"}, 404)
+
+        video_id = entry["id"]
+        title = entry.get("title", "")
+        artist_name = entry.get("uploader", "")
+        thumbnail = entry.get("thumbnail", "")
+        duration = entry.get("duration", 0)
+
+        # 4️⃣ Lyrics still come from YTMusic/transcripts
+        fut_lyrics = _POOL.submit(_fetch_lyrics, query, video_id)
+
+    try:
+        lyrics_text = fut_lyrics.result(timeout=LYRICS_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        lyrics_text = ""
+
+    # 5️⃣ Save lyrics + metadata in the background
+    data = make_meta_json(cache_id, artist_name, title, duration, thumbnail)
+
+    # Populate the LRU before releasing any waiting duplicates, then hand
+    # the disk writes to the writer pool and respond immediately
+    with _META_CACHE_LOCK:
+        _META_CACHE[cache_id] = data
+    CACHED_IDS.add(cache_id)
+    _WRITER.submit(_atomic_write_text, paths.lrc, lyrics_text)
+    _WRITER.submit(_atomic_write_json, paths.meta, data)
+    _WRITER.submit(_record_cache_entry, cache_id, paths)
+
+    if _REDIS is not None:
+        try:
+            # the dl:{cache_id} lock is released by the caller's finally
+            _REDIS.setex(f"meta:{cache_id}", REDIS_META_TTL, orjson.dumps(data))
+        except redis.RedisError:
+            pass
+
+    return _json_response(data)
+
+
+# ---------- STATIC FILE SERVE ----------
+# Only the cache file types themselves are downloadable — never the .tmp
+# files from in-progress atomic writes or anything else that lands here
+SERVABLE_EXTS = {".mp3", f".{AUDIO_EXT}", ".lrc", ".txt", ".json"}
+
+@app.route(f"/{CACHE_DIR}/<path:filename>")
+def serve_cache(filename):
+    if os.path.splitext(filename)[1] not in SERVABLE_EXTS:
+        return _json_response({"error": "file not found"}, 404)
+    if not os.path.exists(os.path.join(CACHE_DIR, filename)):
+        return _json_response({"error": "file not found"}, 404)
+
+    # send_from_directory uses the WSGI file wrapper (sendfile on supported
+    # servers); conditional=True enables Range and If-Modified-Since, which
+    # the ESP32 needs for seeking
+    resp = send_from_directory(CACHE_DIR, filename, conditional=True)
+    # Advertise seekability on full responses too, so clients issue Range
+    # requests instead of re-downloading from byte 0
+    resp.headers.setdefault("Accept-Ranges", "bytes")
+    return resp
+
+
+# ---------- WEB UI ----------
+# Encoded once at import so serving "/" is a constant-bytes response with a
+# stable ETag instead of a per-request str→bytes encode
+_INDEX_HTML = """
+<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="UTF-8" />
+<meta name="viewport" content="width=device-width, initial-scale=1.0">
+<title>🎵 ESP32 Music Server</title>
+<style>
+body {
+  font-family: Arial, sans-serif;
+  background: #101010;
+  color: #eee;
+  display: flex;
+  flex-direction: column;
+  align-items: center;
+  justify-content: flex-start;
+  min-height: 100vh;
+  margin: 0;
+  padding: 2rem;
+}
+h2 {
+  margin-bottom: 1rem;
+  color: #00ff88;
+}
+input, button {
+  font-size: 1rem;
+  padding: 0.5rem;
+  border-radius: 0.5rem;
+  border: none;
+  margin: 0.25rem;
+}
+input {
+  width: 300px;
+}
+button {
+  background: #00ff88;
+  color: black;
+  cursor: pointer;
+}
+button:hover {
+  background: #00cc66;
+}
+img {
+  border-radius: 0.75rem;
+  margin: 1rem 0;
+  box-shadow: 0 0 20px rgba(0,255,136,0.3);
+}
+#lyrics {
+  white-space: pre-wrap;
+  max-width: 600px;
+  text-align: left;
+  background: #181818;
+  padding: 1rem;
+  border-radius: 1rem;
+  box-shadow: 0 0 10px rgba(255,255,255,0.1);
+}
+audio {
+  margin-top: 1rem;
+  width: 90%;
+  max-width: 600px;
+}
+</style>
+</head>
+<body>
+  <h2>🎶 ESP32 YouTube Music Server</h2>
+  <div>
+    <input id="song" type="text" placeholder="Enter song title..." />
+    <input id="artist" type="text" placeholder="Artist (optional)" />
+    <button onclick="searchMusic()">Search</button>
+  </div>
+
+  <div id="result" style="display:none;">
+    <h3 id="title"></h3>
+    <p id="artist_name"></p>
+    <img id="cover" src="" width="200" />
+    <audio id="player" controls></audio>
+    <h4>Lyrics</h4>
+    <div id="lyrics">Loading...</div>
+  </div>
+
+<script>
+async function searchMusic() {
+  const song = document.getElementById('song').value.trim();
+  const artist = document.getElementById('artist').value.trim();
+  if (!song) return alert("Please enter a song name!");
+  const query = encodeURIComponent(song + " " + artist);
+  document.getElementById('result').style.display = 'none';
+  document.getElementById('lyrics').innerText = '';
+
+  try {
+    const res = await fetch(`/stream_pcm?song=${query}`);
+    const data = await res.json();
+    if (data.error) throw new Error(data.error);
+
+    document.getElementById('result').style.display = 'block';
+    document.getElementById('title').innerText = data.title;
+    document.getElementById('artist_name').innerText = data.artist;
+    document.getElementById('cover').src = data.cover_url;
+    document.getElementById('player').src = data.audio_url;
+
+    const lrcRes = await fetch(data.lyric_url);
+    const lrcText = await lrcRes.text();
+    document.getElementById('lyrics').innerText = lrcText || 'No lyrics available.';
+  } catch (err) {
+    alert("Error: " + err.message);
+  }
+}
+</script>
+</body>
+</html>
+""".encode("utf-8")
+_INDEX_ETAG = hashlib.blake2b(_INDEX_HTML, digest_size=8).hexdigest()
+
+
+@app.route("/")
+def web_ui():
+    if request.headers.get("If-None-Match") == _INDEX_ETAG:
+        return Response(status=304, headers={"ETag": _INDEX_ETAG})
+    return Response(
+        _INDEX_HTML,
+        mimetype="text/html",
+        headers={"Cache-Control": "public, max-age=3600", "ETag": _INDEX_ETAG},
+    )
+
+
+
+
+# ---------- MAIN ----------
+if __name__ == "__main__":
+    # Dev entrypoint only — production runs under gunicorn (see
+    # gunicorn.conf.py / Procfile)
+    app.run(host="0.0.0.0", port=10000, threaded=True, debug=False)
+
+
+
+